@@ -19,6 +19,8 @@
 ##        password: "1234"
 ##        server: "hostMachine"
 ##        port: 6080
+##      Progress is written to a checkpoint journal.  If a run is
+##      interrupted, set resumeRun to True to pick up where it stopped.
 ##      
 ##  Service Properties Being Evaluated in this Version:
 ##      maxStartupTime, recycleStartTime, schemaLockingEnabled,
@@ -34,6 +36,26 @@ password = r''
 server = r''
 port = 6080
 
+# Max number of edited services allowed to restart at the same time
+maxServicesRestarting = 2
+
+# Request throttling per ArcGIS Server host.  Concurrency adapts between
+# 1 and maxConcurrentRequests based on response latency and errors.
+maxRequestsPerSecond = 10
+maxConcurrentRequests = 8
+healthyLatencySeconds = 2.0
+
+# Checkpoint journal of each service's progress.  Set resumeRun to True to
+# skip services completed by an earlier, interrupted run.
+checkpointFile = r'..\Logs\ArcServer_EditService - CHECKPOINT.jsonl'
+resumeRun = False
+
+# Collect timings/counters and log a summary table at the end of the run.
+# Set profileRun to also capture a cProfile of the run to profileFile.
+collectPerfStats = False
+profileRun = False
+profileFile = r'..\Logs\ArcServer_EditService.prof'
+
 
 ##############################################################################
 
@@ -43,9 +65,13 @@ import urlparse
 # Custom modules
 import pymdl_logging as log
 import pymdl_ags_rest as customPy
+import pymdl_perf as perf
+import pymdl_throttle as throttle
+import pymdl_checkpoint as checkpoint
 
 
 def main():
+    journal = None
     try:
         # Establish logging
         fh = log.establish(lvl = 'DEBUG',
@@ -53,48 +79,69 @@ def main():
                            logPath = r'..\Logs',
                            backups = 30)
 
+        # Start collecting performance statistics
+        if collectPerfStats or profileRun:
+            perf.enable(profile=profileRun)
+
+        # Throttle requests to the server
+        throttle.configure(rate=maxRequestsPerSecond,
+                           burst=maxRequestsPerSecond,
+                           maxConcurrency=maxConcurrentRequests,
+                           latencyTarget=healthyLatencySeconds)
+
         # Get a token to login to the ArcGIS Server
         token = customPy.generateToken(user, password, server, port, exp=720)
 
         # Get the list of services
         serviceList = customPy.getServiceList(server, port, token)
         log.info('Number of Services: {}'.format(len(serviceList)))
+
+        # Skip services already completed if resuming a run
+        journal = checkpoint.CheckpointJournal(checkpointFile, '{0}:{1}'.format(server, port),
+                                               resume=resumeRun)
+        serviceList = journal.outstanding(serviceList)
+        log.info('Number of Services outstanding: {}'.format(len(serviceList)))
         
+        # Tracks edited services until they have restarted
+        tracker = customPy.ServiceReadinessTracker(server, port, token,
+                                                   maxRestarting=maxServicesRestarting,
+                                                   onReady=lambda s: journal.record(s, checkpoint.VERIFIED))
+
         # Update each service with new property value
         log.info('Getting service properties.  Will update properties if needed.')
-        for service in serviceList:
+        # Properties are fetched concurrently ahead of the edits below
+        for service, svc in customPy.iterServiceModels(server, port, token, serviceList):
 
             # Flag if posting changes are needed
             postTheUpdate = None
 
-            # Get properties for the service
-            sp = customPy.getServiceProperties(server, port, token, service)
+            # Check the properties for the service
+            if svc == False:
+                log.error('Skipping service, unable to get properties: {0}'.format(service))
+                journal.record(service, checkpoint.FAILED, 'Unable to get properties')
+                continue
+            journal.record(service, checkpoint.FETCHED)
 
             # Set the max startup time
             mxStTime = 900
-            if sp['maxStartupTime'] != mxStTime:
-                sp['maxStartupTime'] = mxStTime
+            if svc.maxStartupTime != mxStTime:
+                svc.maxStartupTime = mxStTime
                 postTheUpdate = True
                 log.info('Updating: maxStartupTime to "{0}"'.format(mxStTime))
                 
             # Set Service Recycle Time to not be default value (00:00)
-            if sp['recycleStartTime'] == '00:00':
+            if svc.recycleStartTime == '00:00':
                 newRecycleStartTime = customPy.createRandom24HourTime()
-                sp['recycleStartTime'] = newRecycleStartTime
+                svc.recycleStartTime = newRecycleStartTime
                 postTheUpdate = True
                 log.info('Updating: recycleStartTime to "{0}"'.format(newRecycleStartTime))
 
             # Disable schema locking if the property exist (ex: for map services)
-            if sp.get('properties', None).get('schemaLockingEnabled', None) != None:
+            if svc.getProperty('schemaLockingEnabled') != None:
                 # Test for FEATURE SERVICE and if true skip
-                isFeatureServer = None
-                for d in sp['extensions']:
-                    if d['typeName'] == 'FeatureServer':
-                        if d['enabled'] == 'true':
-                            isFeatureServer = True
-                if isFeatureServer != True:
-                    if sp.get('properties', None).get('schemaLockingEnabled', None) == 'true':
-                        sp['properties']['schemaLockingEnabled'] = 'false'
+                if not svc.isExtensionEnabled('FeatureServer'):
+                    if svc.getProperty('schemaLockingEnabled') == 'true':
+                        svc.setProperty('schemaLockingEnabled', 'false')
                         postTheUpdate = True
                         log.info('Updating: schemaLockingEnabled to "false"')
 
@@ -103,31 +150,53 @@ def main():
             # OnlineResource ex: "MyServer.com"
             desiredOnlineResource = ''
 ##
-            for d in sp['extensions']:
-                if d['typeName'] == 'WMSServer':
-
-                    # Ensure the WMS service is enabled
-                    if d['enabled'] != 'true':
-                        d['enabled'] = 'true'
-                        postTheUpdate = True
-                        log.info('Updating: WMSServer, enabled to "true"')
-
-                    # Examine WMS Online Resource for correct URL network location
-                    onlineResource = urlparse.urlparse(d['properties']['onlineResource'])
-                    if onlineResource.netloc.upper() != desiredOnlineResource:
-                        url = urlparse.urljoin('http://{0}'.format(desiredOnlineResource), onlineResource.path)
-                        d['properties']['onlineResource'] = url
-                        postTheUpdate = True
-                        log.info('Updating: WMSServer, onlineResource to "{0}"'.format(url))
+            wms = svc.getExtension('WMSServer')
+            if wms != None:
+
+                # Ensure the WMS service is enabled
+                if wms.enabled != 'true':
+                    wms.enabled = 'true'
+                    postTheUpdate = True
+                    log.info('Updating: WMSServer, enabled to "true"')
+
+                # Examine WMS Online Resource for correct URL network location
+                onlineResource = urlparse.urlparse(wms.properties['onlineResource'])
+                if onlineResource.netloc.upper() != desiredOnlineResource:
+                    url = urlparse.urljoin('http://{0}'.format(desiredOnlineResource), onlineResource.path)
+                    wms.properties['onlineResource'] = url
+                    postTheUpdate = True
+                    log.info('Updating: WMSServer, onlineResource to "{0}"'.format(url))
 
             # If changes have been made, post the update
             if postTheUpdate:
-                customPy.postUpdatedServiceProperties(server, port, token, service, sp)
+                journal.record(service, checkpoint.PLANNED)
+                # Wait for earlier edits to come back before restarting another service
+                tracker.waitForSlot()
+                if customPy.postUpdatedServiceProperties(server, port, token, service, svc):
+                    journal.record(service, checkpoint.POSTED)
+                    tracker.add(service)
+                else:
+                    journal.record(service, checkpoint.FAILED, 'Unable to edit service')
+            else:
+                journal.record(service, checkpoint.UNCHANGED)
+
+        # Wait on the remaining restarts
+        tracker.waitForAll()
+        log.info('Services restarted: {0}'.format(len(tracker.ready)))
+        if tracker.timedOut:
+            log.warning('Services not ready before timeout: {0}'.format(', '.join(tracker.timedOut)))
 
     except:
         log.exception('Error in main function of script')
         print 'ERROR WITH SCRIPT: {0}'.format(traceback.format_exc())
     finally:
+        # Close the checkpoint even if the run failed so it can be resumed
+        if journal != None:
+            log.info('Checkpoint summary: {0}'.format(journal.summary()))
+            journal.close()
+        if profileRun:
+            perf.dumpProfile(profileFile)
+        perf.logReport()
         log.info('Script Completed')
         log.shutdown(fh)
 
@@ -20,46 +20,108 @@ import httplib
 import urllib
 import json
 import random
+import time
+import threading
+import collections
+import itertools
+from multiprocessing.pool import ThreadPool
 
 # Custom modules
 import pymdl_logging as log
+import pymdl_perf as perf
+import pymdl_throttle as throttle
+from pymdl_ags_service import ServiceModel
 
 
 #########################
 ## General HTTP Functions
 
 
-def postHttpRequest(serverName, serverPort, URL, URL_ParamsEncoded):
+def postHttpRequest(serverName, serverPort, URL, URL_ParamsEncoded, extraHeaders=None, responseInfo=None, method='POST',
+                    throttleSample=True):
     """Post the Http Request and return response.
 
     serverName: The name or IP of ArcGIS Server
     serverPort: The port number to ArcGIS Server
     URL: The REST endpoint to POST to
     URL_ParamsEncoded: The urllib.urlencode parameters to POST
+    extraHeaders: Optional dictionary of additional request headers
+    responseInfo: Optional dictionary filled with the response 'status',
+        'etag' and 'last-modified' values (used for cache revalidation)
+    method: 'POST' (default) or 'GET'.  GET sends the parameters in the
+        query string and is needed for conditional requests.
+    throttleSample: False to keep this request's latency out of the adaptive
+        concurrency controller (for slow-by-design calls such as edits)
     return: JSON response or False
     """
+    hostThrottle = None
+    startTime = None
+    serverOk = False
     try:
         #log.debug(r'Attempting to POST to {0}:{1}{2}?{3}'.format(serverName, serverPort, URL, URL_ParamsEncoded))
+        # Wait for the host's rate limit and concurrency limit
+        hostThrottle = throttle.getHostThrottle(serverName, serverPort)
+        if hostThrottle != None:
+            t0 = perf.start()
+            startTime = hostThrottle.acquire()
+            perf.stop('http.throttle_wait', t0)
+        perf.increment('http.requests')
         httpConn = httplib.HTTPConnection(serverName, serverPort)
-        headers = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"}
-        httpConn.request('POST', URL, URL_ParamsEncoded, headers)
+        if method == 'GET':
+            headers = {"Accept": "text/plain"}
+            requestURL = '{0}?{1}'.format(URL, URL_ParamsEncoded)
+            body = None
+        else:
+            headers = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"}
+            requestURL = URL
+            body = URL_ParamsEncoded
+        if extraHeaders:
+            headers.update(extraHeaders)
+        # DNS lookup, connect and sending the request
+        t0 = perf.start()
+        httpConn.request(method, requestURL, body, headers)
+        perf.stop('http.connect_send', t0)
+        # Server think time until the response headers arrive
+        t0 = perf.start()
         response = httpConn.getresponse()
+        perf.stop('http.server_wait', t0)
+        if responseInfo is not None:
+            responseInfo['status'] = response.status
+            responseInfo['etag'] = response.getheader('etag')
+            responseInfo['last-modified'] = response.getheader('last-modified')
+        # A conditional request found the resource unchanged
+        if response.status == 304 and responseInfo is not None:
+            httpConn.close()
+            serverOk = True
+            return False
         # Determine if the response is successful or not
         if (response.status != 200):
             httpConn.close()
+            perf.increment('http.errors')
             log.error('Server response was not OK: {0}'.format(response.status))
             return False
         else:
+            t0 = perf.start()
             data = response.read()
             httpConn.close()
+            perf.stop('http.read', t0)
+            serverOk = True
             # Determine if JSON response is successful or not
+            t0 = perf.start()
             if not assertJsonSuccess(data):
+                perf.increment('http.errors')
                 return False
             jsonResponse = json.loads(data)
+            perf.stop('http.json_decode', t0)
             return jsonResponse
     except:
+        perf.increment('http.errors')
         log.exception('Error with postHttpRequest()')
         return False
+    finally:
+        # Feed the latency and outcome back to the concurrency controller
+        if startTime != None:
+            hostThrottle.release(startTime, serverOk, throttleSample)
 
 
 def assertJsonSuccess(data):
@@ -166,31 +228,133 @@ def getServiceList(serverName, serverPort, token):
         return []
 
 
-def getServiceProperties(serverName, serverPort, token, service):
+def getServiceProperties(serverName, serverPort, token, service, useCache=True):
     """Via the ArcGIS Server REST API, request service properties.
 
     serverName: The name or IP of ArcGIS Server
     serverPort: The port number to ArcGIS Server
     token: A valid token
     service: The "Folder/ServiceName.ServiceType" representation of a service
+    useCache: True/False flag to read through the service definition cache
     return: HTTP response containing service properties
     """
+    t0 = perf.start()
     try:
+        # Serve repeat reads from the cache while the entry is fresh
+        entry = None
+        if useCache and _serviceCache.enabled:
+            entry = _serviceCache.lookup(serverName, serverPort, service)
+            if entry != None and not entry.isExpired(_serviceCache.ttl):
+                perf.increment('cache.hit')
+                log.debug('Service properties served from cache: {}'.format(service))
+                return entry.copyValue()
+            perf.increment('cache.miss')
+
         log.info('Getting properties for service: {}'.format(service))
         serviceURL = r'/arcgis/admin/services/{}'.format(service)
         #log.debug('Getting JSON definition for Service URL: {0}:{1}{2}'.format(serverName, serverPort, serviceURL))
         paramsUrlencoded = urllib.urlencode({'token': token, 'f': 'json'})
-        r = postHttpRequest(serverName, serverPort, serviceURL, paramsUrlencoded)
+
+        # Revalidate an expired entry if the server supplied validators
+        conditionalHeaders = {}
+        if entry != None:
+            if entry.etag:
+                conditionalHeaders['If-None-Match'] = entry.etag
+            if entry.lastModified:
+                conditionalHeaders['If-Modified-Since'] = entry.lastModified
+        responseInfo = {}
+        r = False
+        if conditionalHeaders:
+            # Sent as GET: a matching precondition on a POST returns 412, not 304
+            r = postHttpRequest(serverName, serverPort, serviceURL, paramsUrlencoded,
+                                extraHeaders=conditionalHeaders, responseInfo=responseInfo,
+                                method='GET')
+            if responseInfo.get('status') == 304:
+                perf.increment('cache.revalidated')
+                log.debug('Cached service properties still valid: {}'.format(service))
+                entry.touch()
+                return entry.copyValue()
+            if r == False:
+                log.debug('Revalidation failed, fetching service properties again: {}'.format(service))
+                responseInfo = {}
+
+        # Unconditional fetch
+        if r == False:
+            r = postHttpRequest(serverName, serverPort, serviceURL, paramsUrlencoded,
+                                responseInfo=responseInfo)
 
         # Determine if return is valid and return
         if r == False:
             log.error('Unable to get service JSON definition due to failed POST')
             return False
         else:
+            if useCache and _serviceCache.enabled:
+                _serviceCache.store(serverName, serverPort, service, r,
+                                    responseInfo.get('etag'), responseInfo.get('last-modified'))
             return r
     except:
         log.exception('Unable to get service properties')
         return False
+    finally:
+        perf.stop('ags.getServiceProperties', t0)
+
+
+def getServiceModel(serverName, serverPort, token, service, useCache=True):
+    """Request service properties and return them as a compact ServiceModel.
+
+    serverName: The name or IP of ArcGIS Server
+    serverPort: The port number to ArcGIS Server
+    token: A valid token
+    service: The "Folder/ServiceName.ServiceType" representation of a service
+    useCache: True/False flag to read through the service definition cache
+    return: ServiceModel or False
+    """
+    try:
+        r = getServiceProperties(serverName, serverPort, token, service, useCache)
+        if r == False:
+            return False
+        else:
+            return ServiceModel.fromDict(r)
+    except:
+        log.exception('Unable to build service model')
+        return False
+
+
+def iterServiceModels(serverName, serverPort, token, services, workers=None):
+    """Fetch service models concurrently, yielding them in list order.
+
+    A bounded number of services are fetched ahead of the caller; the host
+    throttle decides how many of those requests are actually in flight.
+    Messages the workers log for arcpy are sent from the calling (main)
+    thread as results are yielded.
+
+    serverName: The name or IP of ArcGIS Server
+    serverPort: The port number to ArcGIS Server
+    token: A valid token
+    services: List of "Folder/ServiceName.ServiceType" services
+    workers: Number of fetch threads (default = throttle max concurrency)
+    return: Generator of (service, ServiceModel or False)
+    """
+    if workers == None:
+        workers = throttle.maxConcurrency()
+    workers = max(1, int(workers))
+    pool = ThreadPool(workers)
+    try:
+        serviceIter = iter(services)
+        pending = collections.deque()
+        for service in itertools.islice(serviceIter, workers * 2):
+            pending.append((service, pool.apply_async(perf.runProfiled, (getServiceModel, serverName, serverPort, token, service))))
+        while pending:
+            service, result = pending.popleft()
+            for nextService in itertools.islice(serviceIter, 1):
+                pending.append((nextService, pool.apply_async(perf.runProfiled, (getServiceModel, serverName, serverPort, token, nextService))))
+            svc = result.get()
+            log.flushArcpyMessages()
+            yield service, svc
+    finally:
+        pool.close()
+        pool.join()
+        log.flushArcpyMessages()
 
 
 def postUpdatedServiceProperties(serverName, serverPort, token, service, serviceProperties):
@@ -200,27 +364,289 @@ def postUpdatedServiceProperties(serverName, serverPort, token, service, service
     serverPort: The port number to ArcGIS Server
     token: A valid token
     service: The "Folder/ServiceName.ServiceType" representation of a service
-    serviceProperties: The JSON representation of the service
+    serviceProperties: The JSON representation (or ServiceModel) of the service
+    return: True or False
     """
     try:
         # Serialize back into JSON
-        updatedSvcJson = json.dumps(serviceProperties)
+        if isinstance(serviceProperties, ServiceModel):
+            updatedSvcJson = serviceProperties.toJson()
+        else:
+            updatedSvcJson = json.dumps(serviceProperties)
 
         # POST updates back to service
         serviceURL = r'/arcgis/admin/services/{}/edit'.format(service)
         log.debug('Service Edit URL: {0}:{1}{2}'.format(serverName, serverPort, serviceURL))
         paramsUrlencoded = urllib.urlencode({'token': token, 'f': 'json', 'service': updatedSvcJson})
-        r = postHttpRequest(serverName, serverPort, serviceURL, paramsUrlencoded)
+        # Edits block while the service restarts, so keep them out of the
+        # latency samples used to size fetch concurrency
+        r = postHttpRequest(serverName, serverPort, serviceURL, paramsUrlencoded,
+                            throttleSample=False)
         if r == False:
             log.error('Unable to edit service due to failed POST')
             return False
         else:
             log.info('Service Successfully Edited')
+            # The cached definition no longer matches the server
+            _serviceCache.invalidate(serverName, serverPort, service)
+            return True
     except:
         log.exception('Unable to edit service')
         return False
 
 
+def getServiceStatus(serverName, serverPort, token, service):
+    """Via the ArcGIS Server REST API, request the status of a service.
+
+    serverName: The name or IP of ArcGIS Server
+    serverPort: The port number to ArcGIS Server
+    token: A valid token
+    service: The "Folder/ServiceName.ServiceType" representation of a service
+    return: Dictionary with configuredState and realTimeState or False
+    """
+    try:
+        statusURL = r'/arcgis/admin/services/{}/status'.format(service)
+        paramsUrlencoded = urllib.urlencode({'token': token, 'f': 'json'})
+        r = postHttpRequest(serverName, serverPort, statusURL, paramsUrlencoded,
+                            throttleSample=False)
+        if r == False:
+            log.error('Unable to get service status due to failed POST')
+            return False
+        else:
+            return r
+    except:
+        log.exception('Unable to get service status')
+        return False
+
+
+##########################
+## Service Definition Cache
+
+
+class _CacheEntry(object):
+    """A cached service definition and its HTTP validators.
+
+    The definition is held as compact JSON text rather than nested
+    dictionaries: one string per service keeps the cache small, and
+    decoding it is the copy handed to each caller.
+    """
+
+    __slots__ = ('text', 'etag', 'lastModified', 'stored')
+
+    def __init__(self, value, etag=None, lastModified=None):
+        self.text = json.dumps(value, separators=(',', ':'))
+        self.etag = etag
+        self.lastModified = lastModified
+        self.stored = time.time()
+
+    def isExpired(self, ttl):
+        """True when the entry is older than ttl seconds"""
+        return (time.time() - self.stored) > ttl
+
+    def touch(self):
+        """Mark the entry as freshly validated"""
+        self.stored = time.time()
+
+    def copyValue(self):
+        """Return a copy so callers can edit it without touching the cache"""
+        return json.loads(self.text)
+
+
+class ServiceCache(object):
+    """Read-through LRU cache of service definitions with a TTL.
+
+    Entries are keyed by (serverName, serverPort, service).  Expired entries
+    are kept so they can be revalidated with a conditional request.
+    """
+
+    def __init__(self, ttl=300, maxEntries=512, enabled=True):
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.enabled = enabled
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, serverName, serverPort, service):
+        """Return the entry for a service (fresh or expired) or None"""
+        key = (serverName, serverPort, service)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry != None:
+                # Re-insert to mark as most recently used
+                self._entries[key] = entry
+            return entry
+
+    def store(self, serverName, serverPort, service, value, etag=None, lastModified=None):
+        """Add or replace a service definition, evicting the least recently used"""
+        key = (serverName, serverPort, service)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = _CacheEntry(value, etag, lastModified)
+            while len(self._entries) > self.maxEntries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, serverName, serverPort, service):
+        """Drop a single service definition"""
+        with self._lock:
+            self._entries.pop((serverName, serverPort, service), None)
+
+    def clear(self):
+        """Drop all service definitions"""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Module level cache shared by the REST functions
+_serviceCache = ServiceCache()
+
+
+def configureServiceCache(ttl=300, maxEntries=512, enabled=True):
+    """Configure the service definition cache used by getServiceProperties().
+
+    ttl: Seconds an entry is served before being revalidated (default = 300)
+    maxEntries: Number of services held before LRU eviction (default = 512)
+    enabled: True/False flag to turn caching on or off
+
+    Note: getServiceModel() reads through this cache too.  Each entry is
+    the service JSON text, so memory grows with maxEntries times the
+    definition size on top of any ServiceModel objects the caller keeps.
+    """
+    _serviceCache.ttl = ttl
+    _serviceCache.maxEntries = maxEntries
+    _serviceCache.enabled = enabled
+    if not enabled:
+        _serviceCache.clear()
+    log.debug('Service cache configured: ttl={0}, maxEntries={1}, enabled={2}'.format(ttl, maxEntries, enabled))
+
+
+def clearServiceCache():
+    """Remove all cached service definitions"""
+    _serviceCache.clear()
+
+
+#####################
+## Service Readiness
+
+
+class ServiceReadinessTracker(object):
+    """Track edited services until ArcGIS Server reports them started again.
+
+    Each pending service is polled with its own backoff delay, which grows
+    while the service is still restarting.  The first delay for a new
+    service is seeded from the average restart time seen so far, so quick
+    servers are polled quickly and slow ones are not hammered.
+
+    Usage:
+        tracker = ServiceReadinessTracker(server, port, token, maxRestarting=2)
+        for service in services:
+            tracker.waitForSlot()
+            if postUpdatedServiceProperties(...):
+                tracker.add(service)
+        tracker.waitForAll()
+    """
+
+    def __init__(self, serverName, serverPort, token, maxRestarting=2,
+                 initialDelay=1.0, maxDelay=30.0, backoff=2.0, timeout=600,
+                 onReady=None):
+        """serverName: The name or IP of ArcGIS Server
+        serverPort: The port number to ArcGIS Server
+        token: A valid token
+        maxRestarting: Max number of services allowed to restart at once
+        initialDelay: Minimum seconds before the first status poll
+        maxDelay: Maximum seconds between status polls
+        backoff: Multiplier applied to the delay after each not-ready poll
+        timeout: Seconds to wait on a service before giving up on it
+        onReady: Optional function called with each service once it is ready
+        """
+        self.serverName = serverName
+        self.serverPort = serverPort
+        self.token = token
+        self.maxRestarting = max(1, int(maxRestarting))
+        self.initialDelay = initialDelay
+        self.maxDelay = maxDelay
+        self.backoff = backoff
+        self.timeout = timeout
+        self.onReady = onReady
+        self.ready = []
+        self.timedOut = []
+        # service: [startTime, nextPollTime, currentDelay]
+        self._pending = {}
+        self._avgRestart = None
+
+    def add(self, service):
+        """Start tracking a service that has just been edited"""
+        now = time.time()
+        delay = self.initialDelay
+        if self._avgRestart != None:
+            delay = min(self.maxDelay, max(delay, self._avgRestart / 2.0))
+        self._pending[service] = [now, now + delay, delay]
+        log.debug('Tracking restart of {0} (first poll in {1:.1f}s)'.format(service, delay))
+
+    def pendingCount(self):
+        """Number of services still restarting"""
+        return len(self._pending)
+
+    def poll(self):
+        """Check every pending service that is due for a status poll"""
+        now = time.time()
+        for service, state in self._pending.items():
+            startTime, nextPoll, delay = state
+            if nextPoll > now:
+                continue
+            if self._isReady(service):
+                elapsed = time.time() - startTime
+                del self._pending[service]
+                self.ready.append(service)
+                # Exponentially weighted average of observed restart times
+                if self._avgRestart == None:
+                    self._avgRestart = elapsed
+                else:
+                    self._avgRestart = 0.7 * self._avgRestart + 0.3 * elapsed
+                log.info('Service ready after {0:.1f}s: {1}'.format(elapsed, service))
+                if self.onReady != None:
+                    self.onReady(service)
+            elif (now - startTime) > self.timeout:
+                del self._pending[service]
+                self.timedOut.append(service)
+                log.warning('Service not ready after {0}s, no longer waiting: {1}'.format(self.timeout, service))
+            else:
+                delay = min(self.maxDelay, delay * self.backoff)
+                state[1] = time.time() + delay
+                state[2] = delay
+
+    def waitForSlot(self):
+        """Block until fewer than maxRestarting services are restarting"""
+        while len(self._pending) >= self.maxRestarting:
+            self._sleepUntilNextPoll()
+            self.poll()
+
+    def waitForAll(self):
+        """Block until every tracked service is ready or timed out"""
+        while self._pending:
+            self._sleepUntilNextPoll()
+            self.poll()
+
+    def _sleepUntilNextPoll(self):
+        """Sleep until the earliest scheduled status poll"""
+        if self._pending:
+            nextPoll = min(state[1] for state in self._pending.values())
+            wait = nextPoll - time.time()
+            if wait > 0:
+                time.sleep(wait)
+
+    def _isReady(self, service):
+        """True when the service is started, or is configured to be stopped"""
+        status = getServiceStatus(self.serverName, self.serverPort, self.token, service)
+        if status == False:
+            return False
+        if status.get('configuredState') == 'STOPPED':
+            return True
+        return status.get('realTimeState') == 'STARTED'
+
+
 ###################
 ## Helper Functions
 
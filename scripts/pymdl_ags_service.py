@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+###############################################################################
+##
+##  Script: pymdl_ags_service.py
+##  Purpose: A compact in-memory model of an ArcGIS Server 10.2.2 service
+##      definition, used in place of the raw nested JSON dictionaries.
+##
+##  Usage:
+##      svc = ServiceModel.fromDict(getServiceProperties(...))
+##      if not svc.isExtensionEnabled('FeatureServer'): ...
+##      wms = svc.getExtension('WMSServer')
+##      postUpdatedServiceProperties(..., svc)
+##
+##  Notes:
+##      Fields the scripts work with are held in __slots__ attributes and
+##      extensions are indexed by typeName.  Dictionary keys, typeNames and
+##      a small set of common values ('true', 'false', ...) are interned so
+##      thousands of services share one copy.  Unique values (paths, URLs,
+##      descriptions) are not, so the intern table stays small.  Any other
+##      fields are kept as a compact JSON string and only decoded when the
+##      service is serialized again.
+##
+###############################################################################
+
+
+import json
+import collections
+
+
+###############################################################################
+## LOCAL VARIABLE
+
+
+# Top level service fields held as attributes.  Everything else is raw.
+_serviceFields = ('serviceName', 'type', 'description', 'capabilities',
+                  'provider', 'clusterName', 'configuredState',
+                  'minInstancesPerNode', 'maxInstancesPerNode',
+                  'maxWaitTime', 'maxStartupTime', 'maxIdleTime',
+                  'maxUsageTime', 'recycleInterval', 'recycleStartTime',
+                  'properties')
+
+# Extension fields held as attributes.  Everything else is raw.
+_extensionFields = ('typeName', 'enabled', 'capabilities', 'properties')
+
+# Values repeated across many services that are worth sharing
+_sharedValues = frozenset(['true', 'false', 'STARTED', 'STOPPED',
+                           'MapServer', 'GPServer', 'GeocodeServer',
+                           'ImageServer', 'GeometryServer', 'SearchServer',
+                           'GeoDataServer', 'GlobeServer', 'NAServer',
+                           'ROUND_ROBIN', 'HIGH', 'LOW'])
+
+# Shared table of interned keys and values (works for both str and unicode).
+# Only keys, typeNames and _sharedValues are added, so it stays small.
+_internTable = {}
+
+
+class _Missing(object):
+    """Marker for a field that was not present in the service JSON"""
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'MISSING'
+
+MISSING = _Missing()
+
+
+###############################################################################
+
+
+def _test():
+    """Test function and example of how to use the service model"""
+    print 'Test for Service Model'
+    sp = {'serviceName': 'Roads', 'type': 'MapServer', 'maxStartupTime': 300,
+          'recycleStartTime': '00:00', 'datasets': [{'onServerName': 'DB'}],
+          'properties': {'schemaLockingEnabled': 'true'},
+          'extensions': [{'typeName': 'WMSServer', 'enabled': 'false',
+                          'maxUploadFileSize': 0,
+                          'properties': {'onlineResource': 'http://host/wms'}}]}
+    svc = ServiceModel.fromDict(sp)
+    print svc, svc.isExtensionEnabled('WMSServer'), svc.getProperty('schemaLockingEnabled')
+    svc.getExtension('WMSServer').enabled = 'true'
+    svc.setProperty('schemaLockingEnabled', 'false')
+    print svc.toJson()
+    print 'Round trip unchanged fields: {0}'.format(
+        ServiceModel.fromDict(sp).toDict() == sp)
+    print 'Test Complete'
+
+
+###############################################################################
+
+
+def _internKey(key):
+    """Intern a dictionary key or typeName"""
+    return _internTable.setdefault(key, key)
+
+
+def _intern(value):
+    """Intern keys and common values, recursing into dictionaries and lists"""
+    if isinstance(value, basestring):
+        if value in _sharedValues:
+            return _internTable.setdefault(value, value)
+        return value
+    elif isinstance(value, dict):
+        return dict((_internKey(k), _intern(v)) for k, v in value.iteritems())
+    elif isinstance(value, list):
+        return [_intern(v) for v in value]
+    return value
+
+
+def _packRaw(fields):
+    """Serialize the unmodelled fields into a compact JSON string"""
+    if not fields:
+        return None
+    return json.dumps(fields, separators=(',', ':'))
+
+
+def _unpackRaw(raw):
+    """Decode the unmodelled fields"""
+    if raw == None:
+        return {}
+    return json.loads(raw)
+
+
+class ServiceExtension(object):
+    """An extension (ex: WMSServer, FeatureServer) of a service"""
+
+    __slots__ = _extensionFields + ('_raw',)
+
+    def __init__(self, typeName):
+        self.typeName = _internKey(typeName)
+        self.enabled = MISSING
+        self.capabilities = MISSING
+        self.properties = MISSING
+        self._raw = None
+
+    @classmethod
+    def fromDict(cls, d):
+        """Build an extension from its JSON dictionary"""
+        ext = cls(d.get('typeName'))
+        raw = {}
+        for key, value in d.iteritems():
+            if key in _extensionFields:
+                setattr(ext, key, _intern(value))
+            else:
+                raw[key] = value
+        ext._raw = _packRaw(raw)
+        return ext
+
+    def toDict(self):
+        """Rebuild the JSON dictionary for the extension"""
+        d = _unpackRaw(self._raw)
+        for key in _extensionFields:
+            value = getattr(self, key)
+            if value is not MISSING:
+                d[key] = value
+        return d
+
+    def isEnabled(self):
+        """True when the extension is enabled"""
+        return self.enabled == 'true' or self.enabled is True
+
+
+class ServiceModel(object):
+    """A service definition with extensions indexed by typeName"""
+
+    __slots__ = _serviceFields + ('_extensions', '_hasExtensions', '_raw')
+
+    def __init__(self):
+        for key in _serviceFields:
+            setattr(self, key, MISSING)
+        self._extensions = collections.OrderedDict()
+        self._hasExtensions = False
+        self._raw = None
+
+    @classmethod
+    def fromDict(cls, d):
+        """Build a service model from the getServiceProperties() dictionary"""
+        svc = cls()
+        raw = {}
+        for key, value in d.iteritems():
+            if key in _serviceFields:
+                setattr(svc, key, _intern(value))
+            elif key == 'extensions':
+                svc._hasExtensions = True
+                for e in value:
+                    ext = ServiceExtension.fromDict(e)
+                    svc._extensions[ext.typeName] = ext
+            else:
+                raw[key] = value
+        svc._raw = _packRaw(raw)
+        return svc
+
+    @classmethod
+    def fromJson(cls, text):
+        """Build a service model from the service JSON text"""
+        return cls.fromDict(json.loads(text))
+
+    def toDict(self):
+        """Rebuild the JSON dictionary for posting back to ArcGIS Server"""
+        d = _unpackRaw(self._raw)
+        for key in _serviceFields:
+            value = getattr(self, key)
+            if value is not MISSING:
+                d[key] = value
+        if self._hasExtensions:
+            d['extensions'] = [ext.toDict() for ext in self._extensions.itervalues()]
+        return d
+
+    def toJson(self):
+        """Serialize the service back into JSON text"""
+        return json.dumps(self.toDict())
+
+    def getExtension(self, typeName):
+        """Return the ServiceExtension for typeName or None"""
+        return self._extensions.get(typeName)
+
+    def isExtensionEnabled(self, typeName):
+        """True when the service has the extension and it is enabled"""
+        ext = self._extensions.get(typeName)
+        return ext != None and ext.isEnabled()
+
+    def extensions(self):
+        """Return the list of ServiceExtension objects"""
+        return self._extensions.values()
+
+    def getProperty(self, name, default=None):
+        """Return a value from the service 'properties' dictionary"""
+        if self.properties is MISSING:
+            return default
+        return self.properties.get(name, default)
+
+    def setProperty(self, name, value):
+        """Set a value in the service 'properties' dictionary"""
+        if self.properties is MISSING:
+            self.properties = {}
+        self.properties[_internKey(name)] = _intern(value)
+
+    def __repr__(self):
+        return '<ServiceModel {0}.{1}>'.format(self.serviceName, self.type)
+
+
+###############################################################################
+
+
+if __name__ == '__main__':
+    _test()
+
+
+###############################################################################
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+###############################################################################
+##
+##  Script: pymdl_checkpoint.py
+##  Purpose: A durable checkpoint journal so long running service edit
+##      passes can be resumed after a failure instead of starting over.
+##
+##  Usage:
+##      journal = CheckpointJournal(r'..\Logs\checkpoint.jsonl', 'host:6080', resume=True)
+##      for service in journal.outstanding(serviceList):
+##          journal.record(service, 'fetched')
+##          ...
+##      journal.close()
+##
+##  Notes:
+##      The journal is an append-only file of JSON lines, one per state
+##      change, flushed to disk as it is written.  On resume the file is
+##      replayed and the last state seen for each service wins.  A line
+##      cut short by a crash is removed from the end of the file.
+##
+###############################################################################
+
+
+import os
+import json
+import time
+import threading
+
+# Custom module for logging
+import pymdl_logging as log
+
+
+###############################################################################
+## LOCAL VARIABLE
+
+
+# Service states, in the order a service moves through them
+FETCHED = 'fetched'
+PLANNED = 'planned'
+POSTED = 'posted'
+VERIFIED = 'verified'
+# Nothing needed to change
+UNCHANGED = 'unchanged'
+# The fetch or edit failed and should be retried
+FAILED = 'failed'
+
+# States that need no more work on resume
+_completeStates = (VERIFIED, UNCHANGED)
+
+
+###############################################################################
+
+
+def _test():
+    """Test function and example of how to use the checkpoint journal"""
+    print 'Test for Checkpoint Journal'
+    services = ['Folder/A.MapServer', 'Folder/B.MapServer', 'C.MapServer']
+    journal = CheckpointJournal('TEST_Checkpoint.jsonl', 'localhost:6080')
+    journal.record(services[0], FETCHED)
+    journal.record(services[0], UNCHANGED)
+    journal.record(services[1], POSTED)
+    journal.close()
+    journal = CheckpointJournal('TEST_Checkpoint.jsonl', 'localhost:6080', resume=True)
+    print 'Outstanding: {0}'.format(journal.outstanding(services))
+    print 'Summary: {0}'.format(journal.summary())
+    journal.close()
+    os.remove('TEST_Checkpoint.jsonl')
+    print 'Test Complete'
+
+
+###############################################################################
+
+
+class CheckpointJournal(object):
+    """Record and replay the per-service state of an edit run"""
+
+    def __init__(self, path, host, resume=False):
+        """path: The journal file
+        host: The "server:port" the run is against.  Only entries for this
+            host are replayed.
+        resume: True/False flag to replay an existing journal rather than
+            start a new one
+        """
+        self.path = path
+        self.host = host
+        self._states = {}
+        self._lock = threading.Lock()
+        if resume and os.path.isfile(path):
+            self._replay()
+            mode = 'a'
+            log.info('Resuming from checkpoint: {0} ({1} services recorded)'.format(path, len(self._states)))
+        else:
+            mode = 'w'
+            log.info('Starting new checkpoint: {0}'.format(path))
+        self._file = open(path, mode)
+
+    def _replay(self):
+        """Load the last recorded state of each service.  A partial last line
+        is cut from the file so new entries start on a line of their own."""
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        end = data.rfind('\n') + 1
+        for line in data[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                log.warning('Ignoring invalid checkpoint line: {0}'.format(line.strip()))
+                continue
+            if not isinstance(entry, dict) or 'service' not in entry or 'state' not in entry:
+                log.warning('Ignoring invalid checkpoint line: {0}'.format(line.strip()))
+                continue
+            if entry.get('host') == self.host:
+                self._states[entry['service']] = entry['state']
+        if end < len(data):
+            log.warning('Ignoring incomplete checkpoint line: {0}'.format(data[end:].strip()))
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+
+    def record(self, service, state, detail=None):
+        """Durably record a new state for a service
+
+        service: The "Folder/ServiceName.ServiceType" representation of a service
+        state: One of the module state constants (ex: POSTED)
+        detail: Optional message stored with the entry
+        """
+        entry = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'host': self.host,
+                 'service': service, 'state': state}
+        if detail != None:
+            entry['detail'] = detail
+        with self._lock:
+            self._states[service] = state
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def state(self, service):
+        """The last recorded state of a service, or None"""
+        return self._states.get(service)
+
+    def isComplete(self, service):
+        """True when a service needs no more work"""
+        return self._states.get(service) in _completeStates
+
+    def outstanding(self, services):
+        """Return the services (in order) that still need work"""
+        return [s for s in services if not self.isComplete(s)]
+
+    def summary(self):
+        """Return a dictionary of state: number of services"""
+        counts = {}
+        for state in self._states.itervalues():
+            counts[state] = counts.get(state, 0) + 1
+        return counts
+
+    def close(self):
+        """Close the journal file"""
+        if not self._file.closed:
+            self._file.close()
+
+
+###############################################################################
+
+
+if __name__ == '__main__':
+    _test()
+
+
+###############################################################################
@@ -17,6 +17,11 @@ import sys
 import socket
 import logging, logging.handlers
 import traceback
+import threading
+import Queue
+
+# Custom module for performance counters
+import pymdl_perf as perf
 
 
 ###############################################################################
@@ -128,46 +133,94 @@ def establish(lvl='INFO', logName=None, logPath=None, backups=0):
 
 
 
+# arcpy is only called from the main thread.  Messages logged from worker
+# threads are held here until the main thread next logs or flushes.
+_pendingArcpyMessages = Queue.Queue()
+
+
+def _toArcpy(arcpyFunction, message):
+    """Send a message to arcpy, or hold it if not on the main thread"""
+    if isinstance(threading.current_thread(), threading._MainThread):
+        flushArcpyMessages()
+        arcpyFunction(message)
+    else:
+        _pendingArcpyMessages.put((arcpyFunction, message))
+
+
+def flushArcpyMessages():
+    """Send messages logged by worker threads to arcpy (main thread only)"""
+    if not isinstance(threading.current_thread(), threading._MainThread):
+        return
+    while True:
+        try:
+            arcpyFunction, message = _pendingArcpyMessages.get_nowait()
+        except Queue.Empty:
+            return
+        arcpyFunction(message)
+
+
 # Use the following in script to log messages
 def info(message):
     """Info level logging"""
+    t0 = perf.start()
     logging.info('{0}'.format(message))
+    perf.stop('log.python', t0)
     if _logToArcpyMessagingWindow:
-        arcpy.AddMessage('{0}'.format(message))
+        t0 = perf.start()
+        _toArcpy(arcpy.AddMessage, '{0}'.format(message))
+        perf.stop('log.arcpy', t0)
 
 
 def debug(message):
     """Debug level logging"""
+    t0 = perf.start()
     logging.debug('{0}'.format(message))
+    perf.stop('log.python', t0)
     if _logToArcpyMessagingWindow:
-        arcpy.AddMessage('{0}'.format(message))
+        t0 = perf.start()
+        _toArcpy(arcpy.AddMessage, '{0}'.format(message))
+        perf.stop('log.arcpy', t0)
 
 
 def warning(message):
     """Warning level logging"""
+    t0 = perf.start()
     logging.warning('{0}'.format(message))
+    perf.stop('log.python', t0)
     if _logToArcpyMessagingWindow:
-        arcpy.AddWarning('{0}'.format(message))
+        t0 = perf.start()
+        _toArcpy(arcpy.AddWarning, '{0}'.format(message))
+        perf.stop('log.arcpy', t0)
 
         
 def error(message):
     """Error level logging"""
+    t0 = perf.start()
     logging.error('{0}'.format(message))
+    perf.stop('log.python', t0)
     if _logToArcpyMessagingWindow:
-        arcpy.AddWarning('{0}'.format(message))
+        t0 = perf.start()
+        _toArcpy(arcpy.AddWarning, '{0}'.format(message))
+        perf.stop('log.arcpy', t0)
 
 
 def exception(message):
     """Exception logging with stack trace"""
+    t0 = perf.start()
     logging.exception('{0}'.format(message))
+    perf.stop('log.python', t0)
     if _logToArcpyMessagingWindow:
-        arcpy.AddError('{0} \n{1}'.format(message, traceback.format_exc()))
+        t0 = perf.start()
+        _toArcpy(arcpy.AddError, '{0} \n{1}'.format(message, traceback.format_exc()))
+        perf.stop('log.arcpy', t0)
 
 
 def shutdown(fileHandler):
     """Shut-down the logging"""
     try:
         debug('Shutting down logging')
+        if _logToArcpyMessagingWindow:
+            flushArcpyMessages()
         if fileHandler != None:
             logging.getLogger('').removeHandler(fileHandler)
     except:
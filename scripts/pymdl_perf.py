@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+###############################################################################
+##
+##  Script: pymdl_perf.py
+##  Purpose: Lightweight performance counters and latency histograms for
+##      the pymdl_* modules, with an optional cProfile capture mode.
+##
+##  Usage:
+##      Call enable() at the start of a script, then report() or
+##      logReport() at the end.  Instrumented code uses the pattern:
+##          t0 = perf.start()
+##          ...work...
+##          perf.stop('some.metric', t0)
+##      When collection is disabled start() returns None and stop() returns
+##      immediately, so the hooks cost next to nothing.
+##      cProfile only sees the thread that called enable().  Work handed
+##      to worker threads must go through runProfiled() to be included.
+##      See the _test() for example usage.
+##
+###############################################################################
+
+
+import cProfile
+import pstats
+import StringIO
+import threading
+import timeit
+
+
+###############################################################################
+## LOCAL VARIABLE
+
+
+# Upper bounds (in milliseconds) of the latency histogram buckets.
+# Anything slower falls in a final overflow bucket.
+_bucketBounds = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+_enabled = False
+_profiler = None
+_timer = timeit.default_timer
+_lock = threading.Lock()
+# One cProfile per worker thread, see runProfiled()
+_threadProfilers = []
+_threadLocal = threading.local()
+# name: [count, totalSeconds, minSeconds, maxSeconds, bucketCounts]
+_timings = {}
+# name: count
+_counters = {}
+
+
+###############################################################################
+
+
+def _test():
+    """Test function and example of how to use the performance hooks"""
+    print 'Test for Performance Hooks'
+    enable(profile=True)
+    for i in range(50):
+        t0 = start()
+        sum(range(i * 1000))
+        stop('test.sum', t0)
+        increment('test.loops')
+    print report()
+    disable()
+    print 'Test Complete'
+
+
+###############################################################################
+
+
+def enable(profile=False):
+    """Start collecting counters and timings.
+
+    input: profile - True/False flag to also capture a cProfile of the run
+    """
+    global _enabled, _profiler
+    reset()
+    _enabled = True
+    if profile:
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+
+def disable():
+    """Stop collecting counters, timings and any cProfile capture"""
+    global _enabled
+    _enabled = False
+    if _profiler != None:
+        _profiler.disable()
+
+
+def isEnabled():
+    """True when collection is enabled"""
+    return _enabled
+
+
+def reset():
+    """Clear all collected counters, timings and profile data"""
+    global _profiler
+    with _lock:
+        _timings.clear()
+        _counters.clear()
+        del _threadProfilers[:]
+    if _profiler != None:
+        _profiler.disable()
+        _profiler = None
+
+
+# Use the following in instrumented code
+def start():
+    """Return a start time, or None when collection is disabled"""
+    if _enabled:
+        return _timer()
+    return None
+
+
+def stop(name, startTime):
+    """Record the time elapsed since start() under the given metric name"""
+    if startTime == None:
+        return
+    record(name, _timer() - startTime)
+
+
+def record(name, seconds):
+    """Record a duration in seconds under the given metric name"""
+    if not _enabled:
+        return
+    ms = seconds * 1000.0
+    bucket = len(_bucketBounds)
+    for i, bound in enumerate(_bucketBounds):
+        if ms <= bound:
+            bucket = i
+            break
+    with _lock:
+        stats = _timings.get(name)
+        if stats == None:
+            stats = [0, 0.0, seconds, seconds, [0] * (len(_bucketBounds) + 1)]
+            _timings[name] = stats
+        stats[0] += 1
+        stats[1] += seconds
+        if seconds < stats[2]:
+            stats[2] = seconds
+        if seconds > stats[3]:
+            stats[3] = seconds
+        stats[4][bucket] += 1
+
+
+def increment(name, n=1):
+    """Add n to the given counter"""
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def runProfiled(function, *args):
+    """Call function(*args), adding it to the cProfile capture when the
+    call runs on a worker thread and profiling is enabled"""
+    if _profiler == None or not _enabled:
+        return function(*args)
+    profiler = getattr(_threadLocal, 'profiler', None)
+    if profiler == None:
+        profiler = cProfile.Profile()
+        _threadLocal.profiler = profiler
+        with _lock:
+            _threadProfilers.append(profiler)
+    return profiler.runcall(function, *args)
+
+
+def _percentile(buckets, count, pct):
+    """Estimate a percentile (ms) as the upper bound of its histogram bucket"""
+    target = count * pct
+    running = 0
+    for i, n in enumerate(buckets):
+        running += n
+        if running >= target:
+            if i < len(_bucketBounds):
+                return _bucketBounds[i]
+            return float('inf')
+    return float('inf')
+
+
+def report(profileLines=25):
+    """Build an end-of-run summary table.
+
+    input: profileLines - number of cProfile rows to include (if profiling)
+    return: The summary as a string
+    """
+    lines = []
+    with _lock:
+        timings = sorted(_timings.items(), key=lambda item: item[1][1], reverse=True)
+        counters = sorted(_counters.items())
+    lines.append('{0:<40}{1:>8}{2:>12}{3:>10}{4:>10}{5:>10}{6:>10}{7:>10}'.format(
+        'Timing', 'Count', 'Total(s)', 'Mean(ms)', 'Min(ms)', 'p50(ms)', 'p95(ms)', 'Max(ms)'))
+    for name, (count, total, low, high, buckets) in timings:
+        lines.append('{0:<40}{1:>8}{2:>12.3f}{3:>10.1f}{4:>10.1f}{5:>10}{6:>10}{7:>10.1f}'.format(
+            name, count, total, total * 1000.0 / count, low * 1000.0,
+            '<={0}'.format(_percentile(buckets, count, 0.50)),
+            '<={0}'.format(_percentile(buckets, count, 0.95)), high * 1000.0))
+    if counters:
+        lines.append('')
+        lines.append('{0:<40}{1:>8}'.format('Counter', 'Count'))
+        for name, count in counters:
+            lines.append('{0:<40}{1:>8}'.format(name, count))
+    if _profiler != None and profileLines:
+        stream = StringIO.StringIO()
+        stats = pstats.Stats(_profiler, stream=stream)
+        for profiler in _threadProfilers:
+            stats.add(profiler)
+        stats.sort_stats('cumulative').print_stats(profileLines)
+        lines.append('')
+        lines.append(stream.getvalue())
+    return '\n'.join(lines)
+
+
+def dumpProfile(fileName):
+    """Write the captured cProfile data to a file for use with pstats/snakeviz"""
+    if _profiler != None:
+        stats = pstats.Stats(_profiler)
+        for profiler in _threadProfilers:
+            stats.add(profiler)
+        stats.dump_stats(fileName)
+
+
+def logReport(profileLines=25):
+    """Write the summary table to the log"""
+    # Imported here as pymdl_logging is itself instrumented by this module
+    import pymdl_logging as log
+    if not _timings and not _counters and _profiler == None:
+        return
+    # Stop collecting so the report does not time its own logging
+    disable()
+    for line in report(profileLines).splitlines():
+        log.info(line)
+
+
+###############################################################################
+
+
+if __name__ == '__main__':
+    _test()
+
+
+###############################################################################
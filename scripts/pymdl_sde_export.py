@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+###############################################################################
+#
+# Script: pymdl_sde_export.py
+# Python Version: 2.7
+# Purpose: Store the geodatabase inventories from pymdl_sde_query as typed,
+#   columnar files for analysis across many databases and runs.
+# Usage: exportInventory() writes the getGdbFeaturesViaSql() results to
+#   a partitioned directory tree:
+#       <rootPath>/database=<name>/run_date=<YYYY-MM-DD>/part-<id>.<ext>
+#   Each call appends a new part file.  readInventory() reads the tree
+#   back, skipping partitions outside the requested databases and dates,
+#   and memory-maps the files it reads.  With pyarrow it returns a single
+#   pyarrow.Table; without it a dictionary of column lists.
+#   Arrow IPC (default) and Parquet need the pyarrow package.  Without it
+#   plain CSV files are written and read instead.
+#
+###############################################################################
+
+
+import os
+import csv
+import mmap
+import time
+import uuid
+import traceback
+
+# Custom module for logging
+import pymdl_logging as log
+
+# Optional columnar file support
+try:
+    import pyarrow
+    import pyarrow.parquet
+    _hasArrow = True
+except ImportError:
+    _hasArrow = False
+
+
+###############################################################################
+## LOCAL VARIABLE
+
+
+# Column names, in file order.  database and run_date come from the
+# partition directories rather than being stored in each file.
+COLUMNS = ('dataset', 'name', 'data_type', 'row_count')
+PARTITION_COLUMNS = ('database', 'run_date')
+
+# File extension for each supported format
+_extensions = {'arrow': '.arrow', 'parquet': '.parquet', 'csv': '.csv'}
+
+
+###############################################################################
+
+
+def parseFeatureRecord(record, returnType=True, returnCount=True):
+    """Split a getGdbFeaturesViaSql() string into typed values.
+
+    record: ex: "SomeDataset\SomeFeature,Feature Class,200"
+    returnType: The returnType flag the record was produced with
+    returnCount: The returnCount flag the record was produced with
+    return: Tuple of (dataset, name, data_type, row_count).  Missing values
+        are '' for strings and None for row_count.
+    """
+    parts = record.split(',')
+    expected = 1 + int(bool(returnType)) + int(bool(returnCount))
+    if len(parts) != expected:
+        raise ValueError('Expected {0} fields (returnType={1}, returnCount={2}): {3}'.format(
+            expected, returnType, returnCount, record))
+    path = parts[0]
+    dataType = parts[1] if returnType else ''
+    count = parts[-1] if returnCount else ''
+    if '\\' in path:
+        dataset, name = path.split('\\', 1)
+    else:
+        dataset, name = '', path
+    try:
+        rowCount = int(count)
+    except ValueError:
+        rowCount = None
+    return (dataset, name, dataType, rowCount)
+
+
+def exportInventory(features, rootPath, database, runDate=None, fileFormat=None,
+                    returnType=True, returnCount=True):
+    """Append an inventory to the partitioned columnar store.
+
+    features: List of getGdbFeaturesViaSql() strings
+    rootPath: Root directory of the store
+    database: Name of the geodatabase (ex: the .sde file name)
+    runDate: 'YYYY-MM-DD' date of the run (default = today)
+    fileFormat: 'arrow', 'parquet' or 'csv' (default = arrow if available)
+    returnType: The returnType flag features were produced with
+    returnCount: The returnCount flag features were produced with
+    return: Path of the file written or False
+    """
+    try:
+        fileFormat = _resolveFormat(fileFormat)
+        if runDate == None:
+            runDate = time.strftime('%Y-%m-%d')
+        partPath = os.path.join(rootPath,
+                                'database={0}'.format(_partitionValue(database)),
+                                'run_date={0}'.format(runDate))
+        if not os.path.isdir(partPath):
+            os.makedirs(partPath)
+        # Unique part name so repeat runs append rather than overwrite
+        partName = 'part-{0}-{1}{2}'.format(time.strftime('%H%M%S'), uuid.uuid4().hex[:12],
+                                            _extensions[fileFormat])
+        fileName = os.path.join(partPath, partName)
+
+        rows = [parseFeatureRecord(f, returnType, returnCount) for f in features]
+        log.info('Exporting {0} inventory rows to: {1}'.format(len(rows), fileName))
+        if fileFormat == 'csv':
+            _writeCsv(fileName, rows)
+        else:
+            _writeArrow(fileName, rows, fileFormat)
+        return fileName
+    except:
+        log.exception('Unable to export inventory for: {0}'.format(database))
+        return False
+
+
+def exportGdbInventory(gdb, rootPath, runDate=None, fileFormat=None, maxCountWorkers=4):
+    """Query a geodatabase inventory and append it to the columnar store.
+
+    gdb: path to a .sde file
+    rootPath: Root directory of the store
+    runDate: 'YYYY-MM-DD' date of the run (default = today)
+    fileFormat: 'arrow', 'parquet' or 'csv' (default = arrow if available)
+    maxCountWorkers: Max number of count queries run at once
+    return: Path of the file written or False.  Nothing is written when the
+        query fails or finds no features, so a failed run is not mistaken
+        for a database that lost its features.
+    """
+    # Imported here so reading the store does not require arcpy
+    import pymdl_sde_query
+    features = pymdl_sde_query.getGdbFeaturesViaSql(gdb, returnType=True, returnCount=True,
+                                                    maxCountWorkers=maxCountWorkers,
+                                                    failOnError=True)
+    if features == False:
+        log.error('Inventory query failed, nothing exported for: {0}'.format(gdb))
+        return False
+    if not features:
+        log.error('Inventory query returned no features, nothing exported for: {0}'.format(gdb))
+        return False
+    database = os.path.splitext(os.path.basename(gdb))[0]
+    return exportInventory(features, rootPath, database, runDate, fileFormat)
+
+
+def readInventory(rootPath, databases=None, startDate=None, endDate=None):
+    """Read the columnar store back as columns.
+
+    rootPath: Root directory of the store
+    databases: Optional list of database names to read
+    startDate: Optional first 'YYYY-MM-DD' run date to read
+    endDate: Optional last 'YYYY-MM-DD' run date to read
+    return: With pyarrow, a pyarrow.Table of the database and run_date
+        partition columns plus the inventory columns.  Without pyarrow, a
+        dictionary of column name: list of values with the same columns.
+        Arrow and Parquet parts are skipped without pyarrow.  False if the
+        store could not be read.
+    """
+    tables = []
+    result = dict((c, []) for c in PARTITION_COLUMNS + COLUMNS)
+    try:
+        if databases != None:
+            databases = set(_partitionValue(d) for d in databases)
+        for fileName, database, runDate in _listParts(rootPath):
+            # Prune partitions before opening any files
+            if databases != None and database not in databases:
+                continue
+            if startDate != None and runDate < startDate:
+                continue
+            if endDate != None and runDate > endDate:
+                continue
+            if _hasArrow:
+                tables.append(_withPartitions(_readArrow(fileName), database, runDate))
+            elif not fileName.endswith('.csv'):
+                log.warning('pyarrow is not installed, skipping: {0}'.format(fileName))
+            else:
+                columns = _readCsv(fileName)
+                rowCount = len(columns['name'])
+                for c in COLUMNS:
+                    result[c].extend(columns[c])
+                result['database'].extend([database] * rowCount)
+                result['run_date'].extend([runDate] * rowCount)
+        if _hasArrow:
+            return _concatTables(tables)
+        return result
+    except:
+        log.exception('Unable to read inventory from: {0}'.format(rootPath))
+        return False
+
+
+###################
+## Helper Functions
+
+
+def _resolveFormat(fileFormat):
+    """Pick the file format, falling back to CSV without pyarrow"""
+    if fileFormat == None:
+        fileFormat = 'arrow' if _hasArrow else 'csv'
+    if fileFormat not in _extensions:
+        raise ValueError('Unknown inventory format: {0}'.format(fileFormat))
+    if fileFormat != 'csv' and not _hasArrow:
+        log.warning('pyarrow is not installed, writing CSV instead of {0}'.format(fileFormat))
+        fileFormat = 'csv'
+    return fileFormat
+
+
+def _partitionValue(value):
+    """Make a value safe to use as a partition directory name"""
+    return ''.join(ch if ch.isalnum() or ch in '-_.' else '_' for ch in value)
+
+
+def _listParts(rootPath):
+    """Yield (fileName, database, runDate) for every part file in the store"""
+    for dbDir in sorted(os.listdir(rootPath)):
+        if not dbDir.startswith('database='):
+            continue
+        database = dbDir.split('=', 1)[1]
+        dbPath = os.path.join(rootPath, dbDir)
+        for dateDir in sorted(os.listdir(dbPath)):
+            if not dateDir.startswith('run_date='):
+                continue
+            runDate = dateDir.split('=', 1)[1]
+            datePath = os.path.join(dbPath, dateDir)
+            for partName in sorted(os.listdir(datePath)):
+                if os.path.splitext(partName)[1] in _extensions.values():
+                    yield os.path.join(datePath, partName), database, runDate
+
+
+def _writeCsv(fileName, rows):
+    """Write inventory rows to a CSV file with a header"""
+    with open(fileName, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        for dataset, name, dataType, rowCount in rows:
+            writer.writerow([_utf8(dataset), _utf8(name), _utf8(dataType),
+                             '' if rowCount == None else rowCount])
+
+
+def _readCsv(fileName):
+    """Read a CSV part file through a memory map"""
+    columns = dict((c, []) for c in COLUMNS)
+    if os.path.getsize(fileName) == 0:
+        return columns
+    with open(fileName, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            reader = csv.reader(iter(mm.readline, ''))
+            header = reader.next()
+            for row in reader:
+                for c, value in zip(header, row):
+                    if c == 'row_count':
+                        value = int(value) if value != '' else None
+                    else:
+                        value = value.decode('utf-8')
+                    columns[c].append(value)
+        finally:
+            mm.close()
+    return columns
+
+
+def _writeArrow(fileName, rows, fileFormat):
+    """Write inventory rows to an Arrow IPC or Parquet file"""
+    table = pyarrow.Table.from_arrays(
+        [pyarrow.array([_unicode(r[0]) for r in rows], type=pyarrow.string()),
+         pyarrow.array([_unicode(r[1]) for r in rows], type=pyarrow.string()),
+         pyarrow.array([_unicode(r[2]) for r in rows], type=pyarrow.string()),
+         pyarrow.array([r[3] for r in rows], type=pyarrow.int64())],
+        names=list(COLUMNS))
+    if fileFormat == 'parquet':
+        pyarrow.parquet.write_table(table, fileName)
+    else:
+        sink = pyarrow.OSFile(fileName, 'wb')
+        try:
+            writer = pyarrow.RecordBatchFileWriter(sink, table.schema)
+            writer.write_table(table)
+            writer.close()
+        finally:
+            sink.close()
+
+
+def _readArrow(fileName):
+    """Read a part file as a pyarrow.Table, memory-mapping Arrow/Parquet"""
+    if fileName.endswith('.parquet'):
+        return pyarrow.parquet.read_table(fileName, columns=list(COLUMNS), memory_map=True)
+    elif fileName.endswith('.csv'):
+        # Parts written before pyarrow was installed
+        columns = _readCsv(fileName)
+        return pyarrow.Table.from_arrays(
+            [pyarrow.array(columns[c], type=_arrowType(c)) for c in COLUMNS],
+            names=list(COLUMNS))
+    else:
+        source = pyarrow.memory_map(fileName, 'r')
+        return pyarrow.RecordBatchFileReader(source).read_all()
+
+
+def _arrowType(column):
+    """The pyarrow type of an inventory or partition column"""
+    if column == 'row_count':
+        return pyarrow.int64()
+    return pyarrow.string()
+
+
+def _withPartitions(table, database, runDate):
+    """Add the database and run_date partition columns to a part table"""
+    rowCount = table.num_rows
+    return pyarrow.Table.from_arrays(
+        [pyarrow.array([_unicode(database)] * rowCount, type=pyarrow.string()),
+         pyarrow.array([_unicode(runDate)] * rowCount, type=pyarrow.string())] +
+        [table.column(c) for c in COLUMNS],
+        names=list(PARTITION_COLUMNS + COLUMNS))
+
+
+def _concatTables(tables):
+    """Concatenate part tables without copying the column data"""
+    if not tables:
+        return pyarrow.Table.from_arrays(
+            [pyarrow.array([], type=_arrowType(c)) for c in PARTITION_COLUMNS + COLUMNS],
+            names=list(PARTITION_COLUMNS + COLUMNS))
+    return pyarrow.concat_tables(tables)
+
+
+def _utf8(value):
+    """Encode unicode for the Python 2 csv module"""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _unicode(value):
+    """Decode byte strings for pyarrow string columns"""
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+
+###############################################################################
+
+
+def _test():
+    """Function to test this scipt"""
+    try:
+        print 'TESTING SCRIPT'
+        fh = log.establish('DEBUG', 'TEST_Log.txt')
+
+        rootPath = r'.\Inventory'
+        features = ['SomeDataset\SomeFeature,Feature Class,200',
+                    'SomeTable,Table,',
+                    'SomeFeature,Feature Class,15']
+        exportInventory(features, rootPath, 'SomeGDB', runDate='2014-09-10')
+        exportInventory(features, rootPath, 'SomeGDB', runDate='2014-09-11')
+        inventory = readInventory(rootPath, databases=['SomeGDB'], startDate='2014-09-11')
+        if _hasArrow:
+            inventory = inventory.to_pydict()
+        for row in zip(*[inventory[c] for c in PARTITION_COLUMNS + COLUMNS]):
+            print row
+
+    except:
+        log.exception('Error in main function of script')
+        print 'ERROR WITH SCRIPT: {0}'.format(traceback.format_exc())
+    finally:
+        log.info('TESTING SCRIPT COMPLETED')
+        log.shutdown(fh)
+        print 'TESTING SCRIPT COMPLETED'
+
+
+###############################################################################
+
+
+if __name__ == '__main__':
+    _test()
+
+
+###############################################################################
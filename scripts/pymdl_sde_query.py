@@ -14,6 +14,9 @@
 #   feature count.
 #   Results are returned as a list.  If options are used, then the list
 #   is delimted by commas.
+#   Feature counts are run concurrently by up to maxCountWorkers threads
+#   (the calling thread included), each with its own connection to the
+#   .sde file.
 #
 ###############################################################################
 
@@ -21,27 +24,39 @@
 import os
 import sys
 import traceback
+import Queue
+import threading
 import arcpy
 
 # Custom module for logging
 import pymdl_logging as log
+# Custom module for performance counters
+import pymdl_perf as perf
 
 
 ###############################################################################
 
 
-def getGdbFeaturesViaSql(gdb, returnType=False, returnCount=False):
+def getGdbFeaturesViaSql(gdb, returnType=False, returnCount=False, maxCountWorkers=4,
+                         failOnError=False):
     """Get features from a geodatase using SQL.
 
     gdb: path to a .sde file
     returnType: True/False flag to return the gdb item type
     returnCount: True/False flag to return the feature class count
+    maxCountWorkers: Max number of count queries (and connections, including
+        the main one) run at once
+    failOnError: True/False flag to return False, rather than an empty or
+        partial list, when the gdb cannot be queried
     return: list of features in gdb
     examle return: "SomeDataset\SomeFeature,Feature Class,200"
     """
+    t0 = perf.start()
     try:
         log.info('Getting features via SQL for: {0}'.format(gdb))
         features = []
+        # (index in features, feature class) for the row counts
+        countJobs = []
         count = ''
         dataType = ''
         if arcpy.Exists(gdb):
@@ -83,15 +98,16 @@ def getGdbFeaturesViaSql(gdb, returnType=False, returnCount=False):
                 sde_conn = arcpy.ArcSDESQLExecute(gdb)
                 for key, value in sorted(sqlDict.iteritems()):
                     log.info('Executing SQL: {0}'.format(key))
-                    sde_return = sde_conn.execute(value)
+                    sde_return = _executeSql(sde_conn, value)
                     for items in _processSqlReturn(sde_return):
                         if returnCount:
                             count = ','
                             if key == 'SELECT FEATURE CLASS':
-                                count = _processSqlReturn(sde_conn.execute("""select count(*) from {0}""".format(items)))
-                                count = ',{0}'.format(count)
+                                # Counted once the scan completes
+                                countJobs.append((len(features), items))
+                                count = ''
                         if returnType:
-                            dataType = sde_conn.execute("""select type from sde.gdb_items where name = '{0}'""".format(items))
+                            dataType = _executeSql(sde_conn, """select type from sde.gdb_items where name = '{0}'""".format(items))
                             for key1, value1 in featureDict.iteritems():
                                 if dataType == value1.replace("'", ''):
                                     dataType = ',' + key1
@@ -103,13 +119,13 @@ def getGdbFeaturesViaSql(gdb, returnType=False, returnCount=False):
                             sqlDict2 = {'SELECT FEATURE DATASET FEATURE CLASS':
                                         """select name from sde.gdb_items where TYPE = {0} and PATH like concat('{1}', '{2}')""".format(
                                             featureDict['Feature Class'], ("\\" + items), """\%""")}
-                            sde_return2 = sde_conn.execute(sqlDict2['SELECT FEATURE DATASET FEATURE CLASS'])
+                            sde_return2 = _executeSql(sde_conn, sqlDict2['SELECT FEATURE DATASET FEATURE CLASS'])
                             for things in _processSqlReturn(sde_return2):
                                 if returnCount:
-                                    count = _processSqlReturn(sde_conn.execute("""select count(*) from {0}""".format(things)))
-                                    count = ',{0}'.format(count)
+                                    # Counted once the scan completes
+                                    countJobs.append((len(features), things))
                                 if returnType:
-                                    dataType = sde_conn.execute("""select type from sde.gdb_items where name = '{0}'""".format(things))
+                                    dataType = _executeSql(sde_conn, """select type from sde.gdb_items where name = '{0}'""".format(things))
                                     for key2, value2 in featureDict.iteritems():
                                         if dataType == value2.replace("'", ''):
                                             dataType = ',' + key2
@@ -118,19 +134,122 @@ def getGdbFeaturesViaSql(gdb, returnType=False, returnCount=False):
                                 dataType, count = '',''
                             del sde_return2
                     del sde_return
+                # Run the row counts concurrently and add them in order
+                if countJobs:
+                    counts = _countRows(gdb, sde_conn, [table for index, table in countJobs], maxCountWorkers)
+                    for (index, table), count in zip(countJobs, counts):
+                        features[index] += ',{0}'.format(count)
+                    count = ''
                 del sde_conn
             else:
                 log.error('Unable to get GDB features')
-                return []
+                return False if failOnError else []
         else:
             log.error('GDB does not exist: {0}'.format(gdb))
+            if failOnError:
+                return False
         log.info('Completed SQL queries')
         return features
     except:
         log.exception('Unable to get GDB features')
+        if failOnError:
+            return False
         return features
     finally:
         arcpy.ClearWorkspaceCache_management()
+        perf.stop('sde.getGdbFeaturesViaSql', t0)
+
+
+def _executeSql(sde_conn, sql):
+    """Execute SQL on an ArcSDESQLExecute connection, timing the call
+
+    sde_conn: An arcpy.ArcSDESQLExecute connection
+    sql: The SQL statement to execute
+    return: The raw response from sde_conn.execute(sql)
+    """
+    t0 = perf.start()
+    try:
+        return sde_conn.execute(sql)
+    finally:
+        perf.stop('sde.execute', t0)
+        perf.increment('sde.statements')
+
+
+def _countRows(gdb, sde_conn, tables, maxWorkers):
+    """Get the row count of each table, running up to maxWorkers at once
+
+    The calling thread counts on sde_conn alongside maxWorkers - 1 worker
+    threads, so no more than maxWorkers connections are open.  Counts a
+    worker could not run (ex: it could not connect) are retried on sde_conn.
+
+    gdb: The full path to a .sde file
+    sde_conn: The caller's arcpy.ArcSDESQLExecute connection
+    tables: List of table names to count
+    maxWorkers: Max number of concurrent count queries
+    return: List of counts in the same order as tables
+    """
+    workers = max(1, min(int(maxWorkers), len(tables)))
+    log.info('Counting rows for {0} feature classes ({1} at a time)'.format(len(tables), workers))
+    jobs = Queue.Queue()
+    for index, table in enumerate(tables):
+        jobs.put((index, table))
+    # Counts are written in at their index; None until counted
+    results = [None] * len(tables)
+    threads = [threading.Thread(target=_countWorker, args=(gdb, jobs, results))
+               for i in range(workers - 1)]
+    for t in threads:
+        t.start()
+    _drainCounts(sde_conn, jobs, results)
+    for t in threads:
+        t.join()
+
+    missed = [index for index, count in enumerate(results) if count == None]
+    if missed:
+        log.warning('Retrying {0} row counts on the main connection'.format(len(missed)))
+        for index in missed:
+            results[index] = _countTable(sde_conn, tables[index])
+    return results
+
+
+def _countWorker(gdb, jobs, results):
+    """Run queued count queries on a connection owned by this thread
+
+    arcpy objects must not be shared between threads, so each worker opens
+    its own connection and deletes it when the queue is empty.
+
+    gdb: The full path to a .sde file
+    jobs: Queue of (index, table) to count
+    results: List the counts are written into at their index
+    """
+    sde_conn = None
+    try:
+        sde_conn = arcpy.ArcSDESQLExecute(gdb)
+        _drainCounts(sde_conn, jobs, results)
+    except:
+        log.exception('Error counting rows in: {0}'.format(gdb))
+    finally:
+        if sde_conn != None:
+            del sde_conn
+
+
+def _drainCounts(sde_conn, jobs, results):
+    """Run count queries from the queue on one connection until it is empty
+
+    sde_conn: An arcpy.ArcSDESQLExecute connection owned by this thread
+    jobs: Queue of (index, table) to count
+    results: List the counts are written into at their index
+    """
+    while True:
+        try:
+            index, table = jobs.get_nowait()
+        except Queue.Empty:
+            return
+        results[index] = _countTable(sde_conn, table)
+
+
+def _countTable(sde_conn, table):
+    """Return the row count of a table"""
+    return _processSqlReturn(_executeSql(sde_conn, """select count(*) from {0}""".format(table)))
 
 
 def _getGdbOwner(gdb):
@@ -156,6 +275,7 @@ def _processSqlReturn(sqlReturn):
     sqlReturn: The response from sde_conn.execute(value)
     return: A list of responces
     """
+    t0 = perf.start()
     try:
         results = []
         if isinstance(sqlReturn, list):
@@ -182,6 +302,8 @@ def _processSqlReturn(sqlReturn):
     except:
         log.exception('Unable to process the SQL response')
         return []
+    finally:
+        perf.stop('sde.processSqlReturn', t0)
 
 
 ###############################################################################
@@ -197,7 +319,7 @@ def _test():
 
         gdb = r'.\SomeGDB.sde'
         
-        for f in getGdbFeaturesViaSql(gdb, returnType=True, returnCount=True):
+        for f in getGdbFeaturesViaSql(gdb, returnType=True, returnCount=True, maxCountWorkers=4):
             print f
 
     except:
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+###############################################################################
+##
+##  Script: pymdl_throttle.py
+##  Purpose: Per-host request throttling for the ArcGIS Server REST calls.
+##      A token bucket caps the request rate to each host and an AIMD
+##      (additive increase, multiplicative decrease) controller sets how
+##      many requests may be in flight at once based on observed latency
+##      and error rate.
+##
+##  Usage:
+##      configure(rate=10, maxConcurrency=8) at the start of a script, then
+##      wrap each request:
+##          throttle = getHostThrottle(serverName, serverPort)
+##          startTime = throttle.acquire()
+##          ...request...
+##          throttle.release(startTime, success)
+##      pymdl_ags_rest.postHttpRequest() already does this.  Requests whose
+##      latency says nothing about server load (service edits and status
+##      polls) are released with sample=False.
+##
+###############################################################################
+
+
+import time
+import threading
+
+
+###############################################################################
+## LOCAL VARIABLE
+
+
+# Default settings applied to each new host throttle.  See configure().
+_settings = {'enabled': True,
+             'rate': 10.0,
+             'burst': 10,
+             'initialConcurrency': 2,
+             'minConcurrency': 1,
+             'maxConcurrency': 8,
+             'latencyTarget': 2.0,
+             'errorThreshold': 0.1,
+             'window': 10}
+
+# (serverName, serverPort): HostThrottle
+_throttles = {}
+_throttlesLock = threading.Lock()
+
+
+###############################################################################
+
+
+def _test():
+    """Test function and example of how to use the throttle"""
+    print 'Test for Throttle'
+    configure(rate=50, burst=5, initialConcurrency=1, maxConcurrency=4, window=5)
+    throttle = getHostThrottle('localhost', 6080)
+    for i in range(20):
+        startTime = throttle.acquire()
+        time.sleep(0.01)
+        throttle.release(startTime, True)
+    print 'Concurrency limit after fast responses: {0}'.format(throttle.concurrency.limit)
+    for i in range(5):
+        startTime = throttle.acquire()
+        throttle.release(startTime, False)
+    print 'Concurrency limit after errors: {0}'.format(throttle.concurrency.limit)
+    print 'Test Complete'
+
+
+###############################################################################
+
+
+class TokenBucket(object):
+    """Allow on average 'rate' requests per second with bursts of 'burst'"""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(max(1, burst))
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then take it"""
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency(object):
+    """AIMD controller for the number of requests in flight to one host.
+
+    Every 'window' completed requests the average latency and error rate
+    are checked.  While both are healthy the limit grows by one; when
+    either is exceeded the limit is halved.
+    """
+
+    def __init__(self, initial=2, minLimit=1, maxLimit=8, latencyTarget=2.0,
+                 errorThreshold=0.1, window=10):
+        self.minLimit = max(1, int(minLimit))
+        self.maxLimit = max(self.minLimit, int(maxLimit))
+        self.limit = min(self.maxLimit, max(self.minLimit, int(initial)))
+        self.latencyTarget = latencyTarget
+        self.errorThreshold = errorThreshold
+        self.window = max(1, int(window))
+        self._inFlight = 0
+        self._samples = 0
+        self._errors = 0
+        self._latency = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Block until a request slot is free, then take it"""
+        with self._cond:
+            while self._inFlight >= self.limit:
+                self._cond.wait()
+            self._inFlight += 1
+
+    def release(self, latency, success, sample=True):
+        """Return a request slot and record how the request went.
+
+        sample: False to leave the request out of the latency/error window
+            (ex: service edits, which block while the service restarts)
+        """
+        with self._cond:
+            self._inFlight -= 1
+            if not sample:
+                self._cond.notify_all()
+                return
+            self._samples += 1
+            self._latency += latency
+            if not success:
+                self._errors += 1
+            if self._samples >= self.window:
+                self._adjust()
+            self._cond.notify_all()
+
+    def _adjust(self):
+        """Apply the AIMD rule to the last window of requests"""
+        avgLatency = self._latency / self._samples
+        errorRate = float(self._errors) / self._samples
+        if errorRate > self.errorThreshold or avgLatency > self.latencyTarget:
+            self.limit = max(self.minLimit, self.limit // 2)
+        else:
+            self.limit = min(self.maxLimit, self.limit + 1)
+        self._samples, self._errors, self._latency = 0, 0, 0.0
+
+
+class HostThrottle(object):
+    """Rate limiter and concurrency controller for one ArcGIS Server host"""
+
+    def __init__(self, settings):
+        self.bucket = TokenBucket(settings['rate'], settings['burst'])
+        self.concurrency = AdaptiveConcurrency(settings['initialConcurrency'],
+                                               settings['minConcurrency'],
+                                               settings['maxConcurrency'],
+                                               settings['latencyTarget'],
+                                               settings['errorThreshold'],
+                                               settings['window'])
+
+    def acquire(self):
+        """Wait for a rate token and a request slot, return the start time"""
+        self.bucket.acquire()
+        self.concurrency.acquire()
+        return time.time()
+
+    def release(self, startTime, success, sample=True):
+        """Release the request slot taken by acquire()"""
+        self.concurrency.release(time.time() - startTime, success, sample)
+
+
+def configure(**kwargs):
+    """Change the throttle settings.  Existing host throttles are replaced.
+
+    input: enabled - True/False flag to throttle requests at all
+    input: rate - average requests per second to each host
+    input: burst - requests allowed in a burst above the rate
+    input: initialConcurrency - requests in flight to start with
+    input: minConcurrency - lower bound on requests in flight
+    input: maxConcurrency - upper bound on requests in flight
+    input: latencyTarget - average seconds per request considered healthy
+    input: errorThreshold - fraction of failed requests considered healthy
+    input: window - number of requests between concurrency adjustments
+    """
+    for key in kwargs:
+        if key not in _settings:
+            raise ValueError('Unknown throttle setting: {0}'.format(key))
+    with _throttlesLock:
+        _settings.update(kwargs)
+        _throttles.clear()
+
+
+def maxConcurrency():
+    """The configured upper bound on requests in flight to a host"""
+    return _settings['maxConcurrency']
+
+
+def getHostThrottle(serverName, serverPort):
+    """Return the shared HostThrottle for a host, or None if disabled"""
+    if not _settings['enabled']:
+        return None
+    key = (serverName, serverPort)
+    with _throttlesLock:
+        throttle = _throttles.get(key)
+        if throttle == None:
+            throttle = HostThrottle(_settings)
+            _throttles[key] = throttle
+        return throttle
+
+
+###############################################################################
+
+
+if __name__ == '__main__':
+    _test()
+
+
+###############################################################################